@@ -74,4 +74,22 @@ def get_current_user(request: Request):
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token expirado")
     except jwt.PyJWTError:
-        raise HTTPException(status_code=401, detail="Token inválido")
\ No newline at end of file
+        raise HTTPException(status_code=401, detail="Token inválido")
+
+def get_token_user_id(token: Optional[str]) -> Optional[int]:
+    """Extrai o user_id de um token JWT. Retorna None se o token estiver ausente ou for inválido."""
+    if not token:
+        return None
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        return None
+    return payload.get("user_id")
+
+
+def get_current_user_id(request: Request) -> int:
+    """Dependência que retorna o ID numérico do usuário autenticado pelo cookie."""
+    user_id = get_token_user_id(request.cookies.get("access_token"))
+    if user_id is None:
+        raise HTTPException(status_code=401, detail="Token ausente ou inválido")
+    return user_id
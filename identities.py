@@ -3,6 +3,7 @@ from database import Base
 from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, Text, DateTime
 from database import Base
 from datetime import datetime
+from typing import Optional
 
 
 class RoomMembers(Base):
@@ -78,9 +79,11 @@ class Message(Base):
     id = Column(Integer, primary_key=True, index=True)
     room_id = Column(Integer, ForeignKey("rooms.id", ondelete="CASCADE"), nullable=False)
     sender_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
-    receiver_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=True)
+    receiver_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=True, index=True)
     content = Column(Text, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
+    delivered_at = Column(DateTime, nullable=True)  # preenchido quando o push chega ao destinatário
+    read_at = Column(DateTime, nullable=True)  # preenchido quando o destinatário confirma a leitura
 
 class MessageCreate(BaseModel):
     room_id:int
@@ -96,6 +99,8 @@ class MessageOut(BaseModel):
     receiver_id:int
     content:str
     created_at:datetime
+    delivered_at:Optional[datetime] = None
+    read_at:Optional[datetime] = None
 
     class Config:
         orm_mode = True  # permite que o Pydantic leia objetos SQLAlchemy
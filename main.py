@@ -3,20 +3,279 @@ from fastapi.responses import HTMLResponse, FileResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
 import os
 from datetime import datetime
-from fastapi import FastAPI, Depends,WebSocket, WebSocketDisconnect, Response
-from sqlalchemy import or_, and_
+from fastapi import FastAPI, Depends,WebSocket, WebSocketDisconnect, Response, BackgroundTasks
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import or_, and_, update
 from sqlalchemy.orm import Session
-from database import get_db
+from database import get_db, SessionLocal, engine
 from auth import *
 from identities import User, UserCreate, Room, RoomCreate, RoomMembers, MessageCreate, Message, UserAuth, GroupMessagePayload
 import auth
+import profiling
 
 
 app = FastAPI()
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
+# Profiling de queries (opt-in via QUERY_PROFILING=1, ver profiling.py)
+if profiling.install(engine):
+    app.middleware("http")(profiling.query_summary_middleware)
+
 connections = {}
 
+# Canais por usuário: {user_id: {websocket, ...}}
+# Um usuário pode ter vários sockets abertos (uma aba por socket).
+# Usados para empurrar mensagens diretas, eventos de sala e recibos sem polling.
+user_connections = {}
+
+
+def message_event(message: Message, event_type: str):
+    """
+    Serializa uma mensagem no formato enviado pelos canais de usuário.
+    """
+    return {
+        "type": event_type,
+        "message_id": message.id,
+        "room_id": message.room_id,
+        "sender_id": message.sender_id,
+        "receiver_id": message.receiver_id,
+        "content": message.content,
+        "created_at": message.created_at.isoformat() if message.created_at else None,
+    }
+
+
+def room_member_ids(roomId: int, db: Session, exclude: int = None):
+    """
+    Retorna os ids dos membros de uma sala, opcionalmente sem um usuário.
+    """
+    members = db.query(RoomMembers.user_id).filter(RoomMembers.room_id == roomId).all()
+    return [m.user_id for m in members if m.user_id != exclude]
+
+
+async def push_to_user(userId: int, payload: dict):
+    """
+    Envia um evento a todos os sockets abertos de um usuário.
+
+    Retorna:
+        bool: True se o evento chegou a pelo menos um socket, False caso contrário.
+    """
+    delivered = False
+    for websocket in list(user_connections.get(userId, ())):
+        try:
+            await websocket.send_json(payload)
+            delivered = True
+        except Exception:
+            # Conexão morta — descarta apenas este socket
+            remove_user_connection(userId, websocket)
+    return delivered
+
+
+async def push_to_users(userIds: list, payload: dict):
+    """
+    Envia um evento a uma lista de usuários (apenas os conectados recebem).
+    """
+    for userId in userIds:
+        if userId in user_connections:
+            await push_to_user(userId, payload)
+
+
+def remove_user_connection(userId: int, websocket: WebSocket):
+    """
+    Remove um socket do canal do usuário, apagando a entrada quando não sobrar nenhum.
+    """
+    sockets = user_connections.get(userId)
+    if sockets is None:
+        return
+    sockets.discard(websocket)
+    if not sockets:
+        del user_connections[userId]
+
+
+def claim_messages(condition):
+    """
+    Marca como entregues as mensagens que satisfazem a condição e ainda não foram
+    entregues, em um único UPDATE ... RETURNING. Quem "reivindica" a mensagem é
+    quem a empurra, então duas entregas concorrentes nunca enviam a mesma mensagem.
+
+    Retorna:
+        list: eventos "direct" das mensagens reivindicadas, com o delivered_at gravado.
+    """
+    now = datetime.now()
+    db = SessionLocal()
+    try:
+        rows = db.execute(
+            update(Message)
+            .where(condition, Message.delivered_at.is_(None))
+            .values(delivered_at=now)
+            .returning(*Message.__table__.c)
+        ).fetchall()
+        db.commit()
+    finally:
+        db.close()
+    events = []
+    for row in sorted(rows, key=lambda r: r.created_at or now):
+        event = message_event(row, "direct")
+        event["delivered_at"] = row.delivered_at.isoformat()
+        events.append(event)
+    return events
+
+
+def unclaim_messages(messageIds: list):
+    """
+    Desfaz a reivindicação de mensagens que não chegaram a nenhum socket,
+    para que sejam entregues na próxima conexão do destinatário.
+    """
+    db = SessionLocal()
+    try:
+        db.execute(
+            update(Message)
+            .where(Message.id.in_(messageIds))
+            .values(delivered_at=None)
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+async def send_delivered_receipt(event: dict):
+    """
+    Envia ao remetente o recibo de entrega de uma mensagem reivindicada.
+    """
+    await push_to_user(event["sender_id"], {
+        "type": "delivered",
+        "message_id": event["message_id"],
+        "delivered_at": event["delivered_at"]
+    })
+
+
+async def deliver_messages(events: list):
+    """
+    Empurra mensagens diretas recém-criadas aos destinatários conectados.
+    A entrega é reivindicada no banco antes do push (fora do event loop);
+    só as mensagens reivindicadas aqui são enviadas e geram recibo.
+    """
+    ids = [e["message_id"] for e in events if e["receiver_id"] in user_connections]
+    if not ids:
+        return
+    claimed = await run_in_threadpool(claim_messages, Message.id.in_(ids))
+    failed = []
+    for event in claimed:
+        if await push_to_user(event["receiver_id"], event):
+            await send_delivered_receipt(event)
+        else:
+            failed.append(event["message_id"])
+    if failed:
+        await run_in_threadpool(unclaim_messages, failed)
+
+
+async def replay_pending(websocket: WebSocket, userId: int):
+    """
+    Entrega a um socket recém-conectado as mensagens diretas recebidas com o
+    usuário offline. Só este socket recebe o que ele reivindicou, então abas
+    abertas ao mesmo tempo não recebem a mesma mensagem duas vezes.
+    """
+    claimed = await run_in_threadpool(claim_messages, Message.receiver_id == userId)
+    sent = 0
+    try:
+        for event in claimed:
+            await websocket.send_json(event)
+            sent += 1
+            await send_delivered_receipt(event)
+    finally:
+        if sent < len(claimed):
+            await run_in_threadpool(unclaim_messages, [e["message_id"] for e in claimed[sent:]])
+
+
+def mark_as_read(messageId: int, userId: int, db: Session):
+    """
+    Marca uma mensagem direta como lida pelo destinatário.
+
+    Retorna:
+        tuple: (mensagem ou None se não pertencer ao usuário,
+                recibo de leitura para o remetente ou None se já estava lida).
+    """
+    message = db.query(Message).filter(
+        Message.id == messageId,
+        Message.receiver_id == userId
+    ).first()
+    if not message:
+        return None, None
+    if message.read_at is not None:
+        return message, None
+    now = datetime.now()
+    if message.delivered_at is None:
+        message.delivered_at = now
+    message.read_at = now
+    db.commit()
+    receipt = {"type": "read", "message_id": message.id, "read_at": now.isoformat()}
+    return message, receipt
+
+
+def read_from_socket(messageId: int, userId: int):
+    """
+    Versão de mark_as_read com sessão própria, usada pelo canal WebSocket.
+
+    Retorna:
+        tuple ou None: (id do remetente, recibo) se a mensagem foi lida agora.
+    """
+    db = SessionLocal()
+    try:
+        message, receipt = mark_as_read(messageId, userId, db)
+        if not receipt:
+            return None
+        return message.sender_id, receipt
+    finally:
+        db.close()
+
+
+@app.websocket("/ws/users/{userId}")
+async def user_websocket_endpoint(websocket: WebSocket, userId: int):
+    """
+    Canal WebSocket pessoal de um usuário.
+
+    Recebe em tempo real mensagens diretas ("direct"), mensagens de sala
+    ("room_message"), entradas e saídas de membros ("member_joined"/"member_left")
+    e recibos de entrega e leitura ("delivered"/"read").
+    O cliente confirma a leitura enviando {"type": "read", "message_id": ...}.
+    """
+    # Autentica pelo cookie JWT definido no login
+    if get_token_user_id(websocket.cookies.get("access_token")) != userId:
+        await websocket.close(code=1008)
+        return
+
+    await websocket.accept()
+    user_connections.setdefault(userId, set()).add(websocket)
+
+    try:
+        # Entrega as mensagens diretas que chegaram enquanto o usuário estava offline
+        await replay_pending(websocket, userId)
+
+        while True:
+            try:
+                data = await websocket.receive_json()
+            except (ValueError, KeyError):
+                # JSON inválido ou frame binário
+                await websocket.send_json({"type": "error", "detail": "Frame inválido"})
+                continue
+            if not isinstance(data, dict) or data.get("type") != "read":
+                await websocket.send_json({"type": "error", "detail": "Evento desconhecido"})
+                continue
+            try:
+                messageId = int(data.get("message_id"))
+            except (TypeError, ValueError):
+                await websocket.send_json({"type": "error", "detail": "message_id inválido"})
+                continue
+            result = await run_in_threadpool(read_from_socket, messageId, userId)
+            if result:
+                sender_id, receipt = result
+                await push_to_user(sender_id, receipt)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        # Remove apenas este socket (o usuário pode ter outras abas abertas)
+        remove_user_connection(userId, websocket)
+
+
 @app.websocket("/ws/{room_id}/{username}")
 async def websocket_endpoint(websocket: WebSocket, room_id: int, username: str):
     """
@@ -201,7 +460,7 @@ def func():
     return output
 
 @app.post("/rooms/{roomId}/enter")
-def joinRoom(roomId: int, userId: int, userRole:str, db: Session = Depends(get_db)):
+def joinRoom(roomId: int, userId: int, userRole:str, background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
     """
     Adiciona um usuário a uma sala de chat.
     Verifica se o usuário e a sala existem e se o usuário já não está na sala.
@@ -231,6 +490,11 @@ def joinRoom(roomId: int, userId: int, userRole:str, db: Session = Depends(get_d
     db.add(db_members)
     db.commit()
     db.refresh(db_members)  # retorna o objeto atualizado com ID
+    background_tasks.add_task(
+        push_to_users,
+        room_member_ids(roomId, db, exclude=userId),
+        {"type": "member_joined", "room_id": roomId, "user_id": userId}
+    )
     return db_members
     
 
@@ -268,6 +532,8 @@ async def leaveRoom(roomId: int, userId: int, db: Session = Depends(get_db)): #
 
     db.delete(membership)
     db.commit()
+    member_ids = await run_in_threadpool(room_member_ids, roomId, db)
+    await push_to_users(member_ids, {"type": "member_left", "room_id": roomId, "user_id": userId})
     
     return {"message": f"Usuário {userId} saiu da sala {roomId}"}
 
@@ -279,7 +545,7 @@ def get_new_rooms(name:str, db:Session = Depends(get_db) ):
 
 # Adm está se removendo aqui. Precisa implementar a validação JWT/OAuth antes dessa parte
 @app.delete("/rooms/{roomId}/users/{userId}")
-def adminRemove(roomId: int, userId: int, db: Session = Depends(get_db)):
+def adminRemove(roomId: int, userId: int, background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
     """
     Remove um usuário de uma sala, apenas se o solicitante for administrador.
     Verifica se o usuário é admin, se a sala existe e se o usuário faz parte da sala.
@@ -303,6 +569,12 @@ def adminRemove(roomId: int, userId: int, db: Session = Depends(get_db)):
         raise HTTPException(status_code=400, detail="Usuário não faz parte desta sala")
     db.delete(members)
     db.commit()
+    # O usuário removido também recebe o evento (ele não tem outro aviso por este caminho)
+    background_tasks.add_task(
+        push_to_users,
+        room_member_ids(roomId, db) + [userId],
+        {"type": "member_left", "room_id": roomId, "user_id": userId}
+    )
     return {"message": f"Usuário {userId} foi removido da sala {roomId}"}
 
 @app.get("/rooms/{userId}")
@@ -391,9 +663,10 @@ def check_user_admin(roomId: int, userId: int, db: Session = Depends(get_db)):
 
 #----------------MESSAGES-----------------------------------
 @app.post("/messages/direct/{receiverId}")
-def direct(senderId: int, receiverId: int, content: str, user_id: str = Depends(get_current_user), db: Session = Depends(get_db)):
+def direct(senderId: int, receiverId: int, content: str, background_tasks: BackgroundTasks, user_id: str = Depends(get_current_user), db: Session = Depends(get_db)):
     """
     Envia uma mensagem direta entre dois usuários, desde que compartilhem uma sala privada.
+    Se o destinatário estiver conectado em /ws/users/{receiverId}, a mensagem é empurrada na hora.
     
     Parâmetros:
         senderId (int): ID do remetente.
@@ -437,13 +710,16 @@ def direct(senderId: int, receiverId: int, content: str, user_id: str = Depends(
     )
     db.add(message)
     db.commit()
+    db.refresh(message)
+    background_tasks.add_task(deliver_messages, [message_event(message, "direct")])
     return {
         "message": f"Mensagem '{content}' enviada de {senderId} para {receiverId}",
-        "room_id": private_room.id
+        "room_id": private_room.id,
+        "message_id": message.id
     }
 
 @app.post("/rooms/{roomId}/messages")
-def groupMessage(roomId: int, payload: GroupMessagePayload, user_id: str = Depends(get_current_user), db: Session = Depends(get_db)):
+def groupMessage(roomId: int, payload: GroupMessagePayload, background_tasks: BackgroundTasks, user_id: str = Depends(get_current_user), db: Session = Depends(get_db)):
     """
     Envia uma mensagem para todos os membros de uma sala de chat.
     Verifica se o usuário faz parte da sala antes de enviar.
@@ -479,6 +755,11 @@ def groupMessage(roomId: int, payload: GroupMessagePayload, user_id: str = Depen
     db.add(message)
     db.commit()
     db.refresh(message)
+    background_tasks.add_task(
+        push_to_users,
+        room_member_ids(roomId, db, exclude=payload.senderId),
+        message_event(message, "room_message")
+    )
     return {"message": f"Mensagem enviada para sala {roomId}", "message_id": message.id}
 
     
@@ -498,3 +779,25 @@ def getMessages(roomId: int, db: Session = Depends(get_db)):
     return messages
 
 
+@app.post("/messages/{messageId}/read")
+def readMessage(messageId: int, userId: int, background_tasks: BackgroundTasks, current_user_id: int = Depends(get_current_user_id), db: Session = Depends(get_db)):
+    """
+    Marca uma mensagem direta como lida e envia o recibo de leitura ao remetente.
+    Alternativa REST ao evento {"type": "read"} do canal /ws/users/{userId}.
+
+    Parâmetros:
+        messageId (int): ID da mensagem.
+        userId (int): ID do destinatário que leu a mensagem (deve ser o usuário autenticado).
+        db (Session): sessão do banco de dados.
+
+    Retorna:
+        dict: ID da mensagem e horários de entrega e leitura.
+    """
+    if current_user_id != userId:
+        raise HTTPException(status_code=403, detail="Só o destinatário pode marcar a mensagem como lida")
+    message, receipt = mark_as_read(messageId, userId, db)
+    if not message:
+        raise HTTPException(status_code=404, detail="Mensagem não encontrada para este usuário")
+    if receipt:
+        background_tasks.add_task(push_to_user, message.sender_id, receipt)
+    return {"message_id": message.id, "delivered_at": message.delivered_at, "read_at": message.read_at}
@@ -0,0 +1,177 @@
+# profiling.py
+
+import logging
+import os
+import sys
+import sysconfig
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+from sqlalchemy import event
+
+# 1. Configuração (opt-in por variáveis de ambiente)
+# QUERY_PROFILING=1        ativa o profiling das queries
+# SLOW_QUERY_MS=100        queries acima deste tempo (ms) são registradas no log
+# QUERY_EXPLAIN=1          captura o EXPLAIN das queries lentas (SELECT, exceto executemany)
+# N_PLUS_ONE_THRESHOLD=5   repetições da mesma query numa requisição para acusar N+1
+PROFILING_ENABLED = os.getenv("QUERY_PROFILING", "0") == "1"
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "100"))
+EXPLAIN_ENABLED = os.getenv("QUERY_EXPLAIN", "0") == "1"
+N_PLUS_ONE_THRESHOLD = int(os.getenv("N_PLUS_ONE_THRESHOLD", "5"))
+
+logger = logging.getLogger("chat.queries")
+
+# Estatísticas da requisição atual (None fora de uma requisição HTTP)
+_request_stats: ContextVar[Optional["QueryStats"]] = ContextVar("request_stats", default=None)
+
+_PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__)) + os.sep
+_THIS_FILE = os.path.abspath(__file__)
+# Diretórios de bibliotecas (inclusive um venv dentro da pasta do projeto)
+_LIBRARY_DIRS = tuple(
+    os.path.abspath(d) + os.sep
+    for d in {sys.prefix, sys.base_prefix, sysconfig.get_paths()["purelib"], sysconfig.get_paths()["platlib"]}
+)
+_app_file_cache = {}  # {co_filename: bool}
+
+
+class QueryStats:
+    """Acumula as queries executadas durante uma requisição."""
+
+    def __init__(self, route: str):
+        self.route = route
+        self.count = 0
+        self.total_ms = 0.0
+        self.slow = 0
+        self.statements = {}  # {statement: [quantidade, call_site]}
+
+    def add(self, statement: str, elapsed_ms: float, call_site: str, slow: bool):
+        self.count += 1
+        self.total_ms += elapsed_ms
+        if slow:
+            self.slow += 1
+        entry = self.statements.setdefault(statement, [0, call_site])
+        entry[0] += 1
+
+    def repeated(self):
+        """Retorna as queries repetidas acima do limite de N+1."""
+        return [(stmt, n, site) for stmt, (n, site) in self.statements.items() if n >= N_PLUS_ONE_THRESHOLD]
+
+
+# 2. Funções auxiliares
+def _is_app_file(filename: str) -> bool:
+    """Indica se o arquivo é código da aplicação (e não do SQLAlchemy, venv ou deste módulo)."""
+    result = _app_file_cache.get(filename)
+    if result is None:
+        path = os.path.abspath(filename)
+        result = (
+            not filename.startswith("<")  # código gerado, ex.: <string>
+            and path.startswith(_PACKAGE_DIR)
+            and path != _THIS_FILE
+            and not path.startswith(_LIBRARY_DIRS)
+            and "site-packages" not in path
+        )
+        _app_file_cache[filename] = result
+    return result
+
+
+def _call_site() -> str:
+    """Encontra a linha do código da aplicação mais próxima que disparou a query."""
+    frame = sys._getframe(1)
+    while frame is not None:
+        code = frame.f_code
+        if _is_app_file(code.co_filename):
+            return f"{os.path.basename(code.co_filename)}:{frame.f_lineno} ({code.co_name})"
+        frame = frame.f_back
+    return "desconhecido"
+
+
+def _explain(conn, statement: str, parameters) -> Optional[str]:
+    """
+    Executa EXPLAIN para a query em um cursor separado da mesma conexão.
+    Roda dentro de um SAVEPOINT para que uma falha não aborte a transação da requisição.
+    """
+    if not statement.lstrip().upper().startswith("SELECT"):
+        return None
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute("SAVEPOINT profiling_explain")
+        try:
+            cursor.execute("EXPLAIN " + statement, parameters)
+            plan = "\n".join(row[0] for row in cursor.fetchall())
+        except Exception as exc:
+            cursor.execute("ROLLBACK TO SAVEPOINT profiling_explain")
+            plan = f"EXPLAIN falhou: {exc}"
+        cursor.execute("RELEASE SAVEPOINT profiling_explain")
+        return plan
+    except Exception as exc:
+        return f"EXPLAIN falhou: {exc}"
+    finally:
+        cursor.close()
+
+
+# 3. Eventos do SQLAlchemy
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed_ms = (time.perf_counter() - conn.info["query_start_time"].pop()) * 1000
+    stats = _request_stats.get()
+    slow = elapsed_ms >= SLOW_QUERY_MS
+    call_site = _call_site()
+    if stats is not None:
+        stats.add(statement, elapsed_ms, call_site, slow)
+    if not slow:
+        return
+
+    route = stats.route if stats is not None else "-"
+    message = (
+        f"Query lenta ({elapsed_ms:.1f} ms) em {route} [{call_site}]\n"
+        f"{statement}\nParâmetros: {parameters!r}"
+    )
+    if EXPLAIN_ENABLED and not executemany:
+        plan = _explain(conn, statement, parameters)
+        if plan:
+            message += f"\nEXPLAIN:\n{plan}"
+            if "Seq Scan" in plan:
+                message += "\nAviso: varredura sequencial — verifique se falta um índice."
+    logger.warning(message)
+
+
+def install(engine):
+    """
+    Registra os eventos de profiling no engine, se QUERY_PROFILING=1.
+
+    Returns:
+        bool: True se o profiling foi ativado.
+    """
+    if not PROFILING_ENABLED:
+        return False
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    return True
+
+
+# 4. Resumo por requisição
+async def query_summary_middleware(request, call_next):
+    """
+    Middleware HTTP que agrupa as queries da requisição, adiciona os headers
+    X-Query-Count, X-Query-Time-Ms e X-Slow-Query-Count e acusa padrões N+1.
+    """
+    stats = QueryStats(f"{request.method} {request.url.path}")
+    token = _request_stats.set(stats)
+    try:
+        response = await call_next(request)
+    finally:
+        _request_stats.reset(token)
+
+    response.headers["X-Query-Count"] = str(stats.count)
+    response.headers["X-Query-Time-Ms"] = f"{stats.total_ms:.1f}"
+    response.headers["X-Slow-Query-Count"] = str(stats.slow)
+
+    for statement, n, call_site in stats.repeated():
+        logger.warning(
+            f"Possível N+1 em {stats.route}: query executada {n}x [{call_site}]\n{statement}"
+        )
+    return response